@@ -1,15 +1,87 @@
+import atexit
 import json
 import os
 import sys
 import logging
+import logging.handlers
 import sqlite3
 import argparse
+import functools
+import hashlib
+import itertools
+import queue
 import shutil
+import signal
 import subprocess
-from pathlib import Path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# ijson's parse errors don't derive from ValueError, so every manifest parse site catches this tuple
+MANIFEST_PARSE_ERRORS = (ValueError,) + ((ijson.JSONError,) if ijson else ())
+
+# orjson parses several times faster than the stdlib and is used wherever a whole document is decoded
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+class BufferedFileHandler(logging.FileHandler):
+    """
+    FileHandler that writes through a large userland buffer instead of flushing every record.
+    A background thread flushes the buffer every flush_interval seconds, so a record reaches
+    the file within that time even if nothing is logged after it. Errors are flushed
+    immediately, and the buffer is also flushed when the handler is closed.
+    """
+    def __init__(self, filename, buffer_size=65536, flush_interval=1.0):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        super().__init__(filename)
+        self._stop_flushing = threading.Event()
+        threading.Thread(target=self._flush_periodically, name="log-flusher", daemon=True).start()
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=self.buffer_size,
+                    encoding=self.encoding, errors=self.errors)
+
+    def emit(self, record):
+        super().emit(record)
+        if record.levelno >= logging.ERROR:
+            self._flush_now()
+
+    def flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush_now()
+
+    def _flush_now(self):
+        with self.lock:
+            super().flush()
+            self._last_flush = time.monotonic()
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self.flush_interval):
+            self._flush_now()
+
+    def close(self):
+        self._stop_flushing.set()
+        super().close()
+
+def exit_on_sigterm(signum, frame):
+    """Turns SIGTERM into a normal exit so atexit hooks flush buffered logs."""
+    sys.exit(128 + signum)
 
 def setup_logging():
-    """Configures a robust logger."""
+    """
+    Configures a robust logger. Records are handed to a queue and written to the log file
+    and console by a background listener, keeping log I/O off the processing threads.
+    """
     logger = logging.getLogger()
     if logger.hasHandlers():
         logger.handlers.clear()
@@ -17,13 +89,18 @@ def setup_logging():
     logger.setLevel(logging.INFO)
     log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] - %(message)s')
 
-    file_handler = logging.FileHandler("script_run.log")
+    file_handler = BufferedFileHandler("script_run.log")
     file_handler.setFormatter(log_formatter)
-    logger.addHandler(file_handler)
 
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(log_formatter)
-    logger.addHandler(console_handler)
+
+    log_queue = queue.Queue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    listener.start()
+    # Drains any queued records on normal exit and on sys.exit()
+    atexit.register(listener.stop)
 
 def check_dependencies():
     """Checks if required command-line tools are installed."""
@@ -42,6 +119,10 @@ def check_dependencies():
         logging.error(f"  sudo apt-get update && sudo apt-get install {' '.join(missing_apps)}")
         sys.exit(1)
     
+    if ijson is None:
+        logging.warning("Optional Python module 'ijson' is not installed; the manifest will be loaded into memory in full.")
+        logging.warning("  Install it to stream large manifests: pip install ijson")
+
     logging.info("All dependencies are satisfied.")
 
 def db_initialize(db_path):
@@ -55,6 +136,26 @@ def db_initialize(db_path):
                 status TEXT NOT NULL
             )
         ''')
+        # Lets the recovery scan find the few PENDING/DELETED rows without reading every LINKED one.
+        # Partial, so LINKED upserts never touch it
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_status ON processed_files(status) WHERE status != 'LINKED'")
+        # A copy of the last manifest read, so later runs over the same file skip parsing it
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS match_file (
+                set_id INTEGER NOT NULL,
+                filepath TEXT NOT NULL,
+                PRIMARY KEY (set_id, filepath)
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS manifest_source (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                manifest_format TEXT NOT NULL,
+                set_count INTEGER NOT NULL
+            )
+        ''')
         con.commit()
         con.close()
         return True
@@ -62,47 +163,164 @@ def db_initialize(db_path):
         logging.error(f"Database error during initialization: {e}")
         return False
 
-def load_processed_files(db_path):
-    """Reads the state DB to see which files have already been handled."""
-    processed = {}
+def load_recovery_candidates(db_path):
+    """Reads the state DB for files left mid-operation (PENDING/DELETED) by a previous run."""
+    recovery_needed = set()
     try:
         con = sqlite3.connect(db_path)
-        cur = con.cursor()
-        for row in cur.execute("SELECT filepath, status FROM processed_files"):
-            processed[row[0]] = row[1]
+        # The status != 'LINKED' term repeats the partial index's condition so the planner can use it
+        query = "SELECT filepath FROM processed_files WHERE status != 'LINKED' AND status IN ('DELETED', 'PENDING')"
+        for (filepath,) in con.execute(query):
+            recovery_needed.add(filepath)
         con.close()
     except sqlite3.Error as e:
         logging.error(f"Could not read state from database {db_path}: {e}")
-    return processed
+    return recovery_needed
 
-def update_state_db(db_connection, filepath, status):
-    """Atomically inserts or replaces a file's status using an open DB connection."""
+# Stays well below SQLite's bound-parameter limit for a single IN (...) list
+MAX_LOOKUP_PARAMS = 500
+
+def query_linked_files(db_connection, db_lock, filepaths):
+    """
+    Returns the subset of filepaths already LINKED, using primary-key lookups rather than
+    holding every processed path in memory. db_lock serializes use of the shared read connection.
+    """
+    linked = set()
     try:
-        cur = db_connection.cursor()
-        cur.execute("INSERT OR REPLACE INTO processed_files (filepath, status) VALUES (?, ?)", (filepath, status))
-        db_connection.commit()
+        with db_lock:
+            for start in range(0, len(filepaths), MAX_LOOKUP_PARAMS):
+                chunk = filepaths[start:start + MAX_LOOKUP_PARAMS]
+                placeholders = ','.join('?' * len(chunk))
+                query = f"SELECT filepath FROM processed_files WHERE status = 'LINKED' AND filepath IN ({placeholders})"
+                linked.update(filepath for (filepath,) in db_connection.execute(query, chunk))
     except sqlite3.Error as e:
-        logging.error(f"Could not write to state database: {e}")
+        logging.error(f"Could not read state from database: {e}")
+    return linked
+
+def db_connect(db_path):
+    """
+    Opens a long-lived autocommit connection tuned for many small writes.
+    It is created on the main thread but only ever used by the state writer thread.
+    """
+    con = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    # 64 MiB page cache (negative values are KiB) keeps the filepath index hot on large runs
+    con.execute("PRAGMA cache_size=-65536")
+    return con
+
+# Compiled once by the writer connection's statement cache and reused for every update
+UPSERT_STATUS_SQL = "INSERT OR REPLACE INTO processed_files (filepath, status) VALUES (?, ?)"
+
+# Control markers understood by state_db_writer alongside (filepaths, status) updates
+STATE_COMMIT = object()
+STATE_STOP = object()
+
+# Buffered status rows are written with one executemany once this many accumulate
+STATE_BATCH_ROWS = 1000
+
+def write_state_rows(db_connection, rows):
+    """Writes buffered (filepath, status) rows in one statement inside the open transaction."""
+    if not rows:
+        return
+    try:
+        if not db_connection.in_transaction:
+            db_connection.execute("BEGIN")
+        db_connection.executemany(UPSERT_STATUS_SQL, rows)
+    finally:
+        rows.clear()
+
+def state_db_writer(db_connection, state_queue):
+    """
+    Applies queued status updates in order on the single state DB connection.
+    Rows are buffered and written in batches of STATE_BATCH_ROWS; a STATE_COMMIT marker
+    writes whatever is buffered and commits the transaction.
+    """
+    pending_rows = []
+    while True:
+        item = state_queue.get()
+        try:
+            if item is STATE_COMMIT or item is STATE_STOP:
+                write_state_rows(db_connection, pending_rows)
+                if db_connection.in_transaction:
+                    db_connection.execute("COMMIT")
+                if item is STATE_STOP:
+                    break
+            else:
+                filepaths, status = item
+                pending_rows.extend((filepath, status) for filepath in filepaths)
+                if len(pending_rows) >= STATE_BATCH_ROWS:
+                    write_state_rows(db_connection, pending_rows)
+        except sqlite3.Error as e:
+            logging.error(f"Could not write to state database: {e}")
+        finally:
+            state_queue.task_done()
+
+def update_state_db(state_queue, filepath, status):
+    """Queues a file's status change for the state writer thread."""
+    state_queue.put(([filepath], status))
+
+def commit_state_db(state_queue, block=False):
+    """Ends the writer's current transaction; with block=True, waits until it is on disk."""
+    state_queue.put(STATE_COMMIT)
+    if block:
+        state_queue.join()
+
+def build_pool_disks(pool_root):
+    """Lists the physical disk mounts under the pool root once, so lookups don't rescan it."""
+    # Resolved so the disks compare equal to the branch paths mergerfs reports in its xattr.
+    # scandir's cached d_type answers is_dir() without an extra stat per entry
+    with os.scandir(os.path.realpath(pool_root)) as entries:
+        pool_disks = [entry.path for entry in entries if entry.is_dir()]
+    return sorted(pool_disks)
 
-def get_physical_path(mergerfs_path, pool_root, primary_path):
+def get_mergerfs_fullpath(mergerfs_path, pool_disks):
     """
-    Resolves the underlying physical path by checking for the file's existence on each physical disk.
-    This is the most direct and reliable fallback method.
+    Asks mergerfs which branch holds the file via its 'user.mergerfs.fullpath' xattr.
+    One getxattr replaces an existence check per disk; returns (None, None) when unavailable.
     """
     try:
-        # Determine the base of the mergerfs mount to create a relative path
-        # e.g., if primary_path is /mnt/storage/Media, the base is /mnt/storage
-        mergerfs_base = str(Path(primary_path).parent)
-        relative_path = os.path.relpath(mergerfs_path, mergerfs_base)
+        # fsdecode keeps non-UTF-8 branch paths as surrogate escapes instead of raising
+        physical_path = os.fsdecode(os.getxattr(mergerfs_path, 'user.mergerfs.fullpath'))
+    except (AttributeError, OSError):
+        # Not Linux, not a mergerfs mount, or xattrs disabled with xattr=nosys
+        return None, None
+
+    for disk_path in pool_disks:
+        if physical_path.startswith(disk_path + os.sep):
+            return physical_path, disk_path
+    return None, None
+
+def get_physical_path(mergerfs_path, pool_disks, mergerfs_prefix, disk_hints):
+    """
+    Resolves the underlying physical path, preferring mergerfs' own xattr report.
+    Otherwise checks for the file's existence on each physical disk; this is the most
+    direct and reliable fallback method. disk_hints maps a relative directory to the disk
+    its last file was found on, which is checked first since siblings usually share a disk.
+    """
+    physical_path, disk_path = get_mergerfs_fullpath(mergerfs_path, pool_disks)
+    if physical_path:
+        return physical_path, disk_path
+
+    try:
+        if mergerfs_path.startswith(mergerfs_prefix):
+            # The prefix is already normalized, so slicing avoids relpath's two abspath calls
+            relative_path = mergerfs_path[len(mergerfs_prefix):]
+        else:
+            relative_path = os.path.relpath(mergerfs_path, mergerfs_prefix)
+        relative_dir = os.path.dirname(relative_path)
+        hinted_disk = disk_hints.get(relative_dir)
+        if hinted_disk:
+            candidate_disks = [hinted_disk] + [d for d in pool_disks if d != hinted_disk]
+        else:
+            candidate_disks = pool_disks
 
         # Loop through each physical disk and check if the path exists
-        for disk in os.listdir(pool_root):
-            disk_path = os.path.join(pool_root, disk)
-            if not os.path.isdir(disk_path):
-                continue
-            
+        for disk_path in candidate_disks:
             physical_path_to_check = os.path.join(disk_path, relative_path)
             if os.path.exists(physical_path_to_check):
+                disk_hints[relative_dir] = disk_path
                 return physical_path_to_check, disk_path
                 
     except (FileNotFoundError, OSError, ValueError) as e:
@@ -110,138 +328,456 @@ def get_physical_path(mergerfs_path, pool_root, primary_path):
     
     return None, None
 
-def link_file(db_connection, master_physical_path, physical_disk_root, dup_file, primary_path, stats):
-    """Creates directories and the final hardlink."""
-    mergerfs_base = Path(primary_path).parent
-    relative_dup_dir = Path(dup_file).parent.relative_to(mergerfs_base)
+def get_master_physical_path(cache, master_file, pool_disks, mergerfs_prefix, disk_hints, consume=False):
+    """
+    Memoized get_physical_path for master files. Recovery resolves the same master once per
+    broken duplicate; the main loop sees each master in exactly one set, so it passes
+    consume=True to take a recovery-time result without growing the cache for the whole manifest.
+    """
+    if consume:
+        cached = cache.pop(master_file, None)
+        return cached or get_physical_path(master_file, pool_disks, mergerfs_prefix, disk_hints)
+    if master_file not in cache:
+        cache[master_file] = get_physical_path(master_file, pool_disks, mergerfs_prefix, disk_hints)
+    return cache[master_file]
+
+# Link target directories are held open so each linkat() skips re-resolving the directory path.
+# O_PATH is enough for a dirfd and doesn't need read permission on the directory.
+LINK_DIR_FLAGS = os.O_DIRECTORY | getattr(os, 'O_PATH', os.O_RDONLY)
+# Bounds the memory spent remembering ensured directories on very large trees
+MAX_LINK_DIRS = 100000
+
+def ensure_link_dir(link_dirs, link_target_dir):
+    """Creates a link target directory the first time it is seen; link_dirs is the set of directories already ensured."""
+    if link_target_dir in link_dirs:
+        return
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"    - Ensuring directory exists: {link_target_dir}")
+    os.makedirs(link_target_dir, exist_ok=True)
+    if len(link_dirs) >= MAX_LINK_DIRS:
+        # Forgetting a directory only costs a redundant makedirs later
+        link_dirs.clear()
+    link_dirs.add(link_target_dir)
+
+def open_link_dir(dir_fds, link_target_dir):
+    """
+    Returns a descriptor for link_target_dir, kept in dir_fds while links keep going to that directory.
+    Moving on to another directory closes the previous one, so each caller holds at most one.
+    Returns None when dir_fd isn't supported.
+    """
+    if link_target_dir in dir_fds:
+        return dir_fds[link_target_dir]
+
+    close_link_dirs(dir_fds)
+    dir_fd = None
+    if os.link in os.supports_dir_fd and os.rename in os.supports_dir_fd:
+        dir_fd = os.open(link_target_dir, LINK_DIR_FLAGS)
+    dir_fds[link_target_dir] = dir_fd
+    return dir_fd
+
+def close_link_dirs(dir_fds):
+    """Closes the directory descriptor held by open_link_dir, if any."""
+    for dir_fd in dir_fds.values():
+        if dir_fd is not None:
+            os.close(dir_fd)
+    dir_fds.clear()
+
+# Staged links get a fixed-length name derived from the target's, so a file name already near
+# NAME_MAX can still be staged and a retry of the same link replaces its own leftover
+STAGING_PREFIX = '.dedupe-tmp-'
+
+def link_file(state_queue, master_physical_path, physical_disk_root, dup_file, mergerfs_prefix, stats, link_dirs, dir_fds,
+              remove_duplicate=False):
+    """
+    Creates directories and the final hardlink. link_dirs caches directories already ensured and
+    dir_fds holds the caller's open target directory.
+    The link is first staged under a hidden name next to its target, then the duplicate is
+    removed (when remove_duplicate is set) and the staged link renamed into place. The
+    duplicate's path is only missing between the remove and the rename.
+    """
+    if not dup_file.startswith(mergerfs_prefix):
+        raise ValueError(f"{dup_file} is not inside the mergerfs mount {mergerfs_prefix}")
+    relative_dup_dir = os.path.dirname(dup_file)[len(mergerfs_prefix):]
     link_target_dir = os.path.join(physical_disk_root, relative_dup_dir)
-    link_target_path = os.path.join(link_target_dir, os.path.basename(dup_file))
+    link_name = os.path.basename(dup_file)
+    link_target_path = os.path.join(link_target_dir, link_name)
+    staging_name = STAGING_PREFIX + hashlib.sha1(os.fsencode(link_name)).hexdigest()[:16]
+    # Checked once so the per-step messages below aren't formatted when they'd be dropped
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    ensure_link_dir(link_dirs, link_target_dir)
+    dir_fd = open_link_dir(dir_fds, link_target_dir)
+    if dir_fd is None:
+        staging_name = os.path.join(link_target_dir, staging_name)
+        link_name = link_target_path
 
-    logging.info(f"    - Ensuring directory exists: {link_target_dir}")
-    Path(link_target_dir).mkdir(parents=True, exist_ok=True)
+    if debug:
+        logging.debug(f"    - Staging hardlink for: {link_target_path}")
+    try:
+        os.link(master_physical_path, staging_name, dst_dir_fd=dir_fd)
+    except FileExistsError:
+        # Left behind by an interrupted attempt at this same link; it's only ever a link to a master, so replace it
+        os.unlink(staging_name, dir_fd=dir_fd)
+        os.link(master_physical_path, staging_name, dst_dir_fd=dir_fd)
 
-    logging.info(f"    - Creating hardlink at: {link_target_path}")
-    os.link(master_physical_path, link_target_path)
-    update_state_db(db_connection, dup_file, 'LINKED')
+    try:
+        if remove_duplicate:
+            if debug:
+                logging.debug(f"    - Deleting: {dup_file}")
+            try:
+                os.remove(dup_file)
+            except FileNotFoundError:
+                logging.warning(f"    - File not found for deletion (already gone?): {dup_file}. Linking it back.")
+        if debug:
+            logging.debug(f"    - Creating hardlink at: {link_target_path}")
+        os.rename(staging_name, link_name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except BaseException:
+        os.unlink(staging_name, dir_fd=dir_fd)
+        raise
+    update_state_db(state_queue, dup_file, 'LINKED')
     stats['links_created'] += 1
-    logging.info(f"    - SUCCESS! Linked {dup_file}")
+    if debug:
+        logging.debug(f"    - SUCCESS! Linked {dup_file}")
+
+def find_master_file(files, primary_prefix):
+    """Returns the first file of a set that lives under the separator-terminated primary prefix, or None."""
+    for f in files:
+        if f.startswith(primary_prefix):
+            return f
+    return None
+
+def parse_match_sets(stream, manifest_format='json'):
+    """
+    Yields match sets from an open binary stream, validating each one.
+    With ijson installed a jdupes JSON manifest is streamed, so memory stays bounded by a single set.
+    An 'ndjson' manifest holds one match set object per line and is parsed line by line.
+    """
+    if manifest_format == 'ndjson':
+        match_sets = (json_loads(line) for line in stream if line.strip())
+    elif ijson:
+        # use_float keeps numbers as int/float rather than Decimal so sets can be re-serialized
+        match_sets = ijson.items(stream, 'matchSets.item', use_float=True)
+    else:
+        data = json_loads(stream.read())
+        # A non-object top level is passed through so the check below rejects it
+        match_sets = data.get('matchSets', []) if isinstance(data, dict) else [data]
+    for match_set in match_sets:
+        if not isinstance(match_set, dict) or not isinstance(match_set.get('fileList'), list):
+            logging.error("Invalid manifest format: 'matchSets' should be a list of objects, each with a 'fileList' list.")
+            sys.exit(1)
+        yield match_set
+
+def iter_match_sets(json_file, manifest_format='json'):
+    """Yields the match sets of a manifest file one at a time."""
+    try:
+        with open(json_file, 'rb') as f:
+            yield from parse_match_sets(f, manifest_format)
+    except (OSError, *MANIFEST_PARSE_ERRORS) as e:
+        logging.error(f"Could not read or parse manifest {json_file}: {e}")
+        sys.exit(1)
+
+def iter_jdupes_match_sets(scan_paths):
+    """
+    Runs jdupes over scan_paths and yields match sets straight from its JSON output,
+    skipping the manifest file round-trip.
+    """
+    cmd = ['jdupes', '--recurse', '--json', *scan_paths]
+    logging.info(f"Running: {' '.join(cmd)}")
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 20)
+    except OSError as e:
+        logging.error(f"Could not start jdupes: {e}")
+        sys.exit(1)
+
+    finished = False
+    parse_error = None
+    try:
+        yield from parse_match_sets(proc.stdout)
+        finished = True
+    except MANIFEST_PARSE_ERRORS as e:
+        parse_error = e
+    finally:
+        proc.stdout.close()
+        if not finished:
+            # Stopped early; don't wait on a scan that may still have hours to go
+            proc.terminate()
+        returncode = proc.wait()
+
+    # A failed jdupes usually explains unparseable output, so its status is reported first
+    if returncode != 0:
+        logging.warning(f"jdupes exited with status {returncode}; its output may be incomplete.")
+    if parse_error:
+        logging.error(f"Could not parse jdupes output: {parse_error}")
+        sys.exit(1)
+
+MANIFEST_BATCH_ROWS = 10000
+STORED_SETS_PER_READ = 1000
+
+def store_manifest(db_path, json_file, manifest_format):
+    """
+    Copies the manifest's match sets into the state DB unless the same file is already stored there.
+    Returns True when the stored copy can be read instead of the file.
+    """
+    try:
+        st = os.stat(json_file)
+    except OSError as e:
+        logging.error(f"Could not read manifest {json_file}: {e}")
+        sys.exit(1)
+    source = (os.path.abspath(json_file), st.st_size, st.st_mtime_ns, manifest_format)
+
+    con = sqlite3.connect(db_path)
+    try:
+        stored = con.execute("SELECT path, size, mtime_ns, manifest_format FROM manifest_source").fetchone()
+        if stored == source:
+            logging.info("Reading duplicate sets stored in the state database by an earlier run.")
+            return True
+
+        logging.info(f"Storing duplicate sets from {json_file} in the state database...")
+        with con:
+            con.execute("DELETE FROM manifest_source")
+            con.execute("DELETE FROM match_file")
+            rows = []
+            set_count = 0
+            for set_id, match_set in enumerate(iter_match_sets(json_file, manifest_format)):
+                rows.extend((set_id, f['filePath']) for f in match_set['fileList'])
+                set_count = set_id + 1
+                if len(rows) >= MANIFEST_BATCH_ROWS:
+                    con.executemany("INSERT OR IGNORE INTO match_file (set_id, filepath) VALUES (?, ?)", rows)
+                    rows.clear()
+            con.executemany("INSERT OR IGNORE INTO match_file (set_id, filepath) VALUES (?, ?)", rows)
+            con.execute("INSERT INTO manifest_source VALUES (?, ?, ?, ?, ?)", (*source, set_count))
+        return True
+    except sqlite3.Error as e:
+        logging.warning(f"Could not store the manifest in the state database, reading the file directly: {e}")
+        return False
+    finally:
+        con.close()
+
+def iter_stored_match_sets(db_path):
+    """
+    Yields the match sets stored by store_manifest, in manifest order.
+    Sets are read a range of ids at a time so no read transaction stays open against the writer.
+    """
+    con = sqlite3.connect(db_path)
+    try:
+        (set_count,) = con.execute("SELECT set_count FROM manifest_source").fetchone()
+        for start in range(0, set_count, STORED_SETS_PER_READ):
+            # rowid keeps each set's files in the order jdupes listed them
+            rows = con.execute(
+                "SELECT set_id, filepath FROM match_file WHERE set_id >= ? AND set_id < ? ORDER BY set_id, rowid",
+                (start, start + STORED_SETS_PER_READ)
+            ).fetchall()
+            for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+                yield {'fileList': [{'filePath': filepath} for _, filepath in group]}
+    except sqlite3.Error as e:
+        logging.error(f"Could not read stored duplicate sets from the state database: {e}")
+        sys.exit(1)
+    finally:
+        con.close()
+
+def open_manifest(args, manifest_stored=False):
+    """
+    Returns an iterator over the run's match sets: from the copy stored in the state DB,
+    the manifest file, or a live jdupes scan.
+    """
+    if args.from_jdupes:
+        return iter_jdupes_match_sets(args.from_jdupes)
+    if manifest_stored:
+        return iter_stored_match_sets(args.db_file)
+    return iter_match_sets(args.json_file, args.manifest_format)
+
+def new_stats():
+    """Returns a zeroed run statistics dict."""
+    return {'sets_processed': 0, 'links_created': 0, 'recoveries': 0, 'failures': 0}
+
+def merge_stats(stats, set_stats):
+    """Adds one match set's counters into the run totals."""
+    for key, value in set_stats.items():
+        stats[key] += value
+
+def process_match_set(match_set, args, primary_prefix, mergerfs_prefix, pool_disks, disk_hints, master_paths, link_dirs, find_linked, state_queue):
+    """
+    Deletes and relinks every not-yet-linked duplicate of one match set.
+    Safe to run on a worker thread: state writes go through the queue and the counters
+    are returned for the caller to merge.
+    """
+    stats = new_stats()
+    # Staged links left by an interrupted run look like extra copies of the master to a scan
+    files = [f['filePath'] for f in match_set['fileList']
+             if not os.path.basename(f['filePath']).startswith(STAGING_PREFIX)]
+    master_file = find_master_file(files, primary_prefix)
+    
+    if not master_file:
+        return stats
+
+    stats['sets_processed'] += 1
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if debug:
+        logging.debug(f"Processing set for master: {master_file}")
+    
+    others = [f for f in files if f != master_file]
+    linked_files = find_linked(others)
+    # Sorting groups duplicates by directory, so each target directory's links run back-to-back
+    duplicates = sorted((f for f in others if f not in linked_files), key=os.path.dirname)
+    if not duplicates:
+        # Already done on an earlier run; skip resolving the master, but drop any path the
+        # recovery pass cached for it
+        master_paths.pop(master_file, None)
+        return stats
+
+    master_physical_path, physical_disk_root = get_master_physical_path(master_paths, master_file, pool_disks, mergerfs_prefix, disk_hints, consume=True)
+    if not master_physical_path:
+        logging.error(f"    - FATAL: Could not determine physical path for master {master_file}. Skipping set.")
+        stats['failures'] += 1
+        return stats
+
+    if not args.perform_actions:
+        logging.info(f"Processing set for master: {master_file}")
+        for dup_file in duplicates:
+            logging.info(f"  - Found duplicate: {dup_file}")
+            logging.info(f"    - Would delete: {dup_file}")
+            logging.info(f"    - Would create hardlink from '{master_physical_path}'")
+        return stats
+
+    # Only the final LINKED status is recorded, committed once the set is done. A duplicate
+    # removed before a crash could rename its staged link is still absent from the DB, so the
+    # next --json-file run over a manifest listing it finds it already gone and links it then.
+    dir_fds = {}
+    try:
+        for dup_file in duplicates:
+            if debug:
+                logging.debug(f"  - Found duplicate: {dup_file}")
+            try:
+                link_file(state_queue, master_physical_path, physical_disk_root, dup_file, mergerfs_prefix, stats, link_dirs,
+                          dir_fds, remove_duplicate=True)
+            except Exception as e:
+                logging.error(f"    - FAILED to process {dup_file}. Error: {e}")
+                stats['failures'] += 1
+    finally:
+        close_link_dirs(dir_fds)
+    commit_state_db(state_queue)
+    logging.info(f"Processed set for master: {master_file} ({stats['links_created']} linked, {stats['failures']} failed)")
+    return stats
 
 def run_deduplication(args):
     """Main function to execute the deduplication process."""
-    stats = {'sets_processed': 0, 'links_created': 0, 'recoveries': 0, 'failures': 0}
+    stats = new_stats()
 
     if not args.perform_actions:
         logging.warning("--- DRY RUN MODE: No files will be deleted or linked. ---")
 
-    try:
-        with open(args.json_file, 'r') as f:
-            data = json.load(f)
-        match_sets = data.get('matchSets', [])
-        if not isinstance(match_sets, list) or (match_sets and not all('fileList' in s and isinstance(s.get('fileList'), list) for s in match_sets)):
-            logging.error("Invalid manifest format: 'matchSets' should be a list of objects, each with a 'fileList' list.")
-            sys.exit(1)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logging.error(f"Could not read or parse manifest {args.json_file}: {e}")
+    recovery_needed = load_recovery_candidates(args.db_file)
+    if recovery_needed and args.from_jdupes:
+        # These duplicates are already deleted, so a fresh scan can never list them again
+        logging.error(f"Found {len(recovery_needed)} files left half-processed by an earlier run. "
+                      "Rerun with --json-file and a manifest that lists them to recover their links.")
         sys.exit(1)
+    manifest_stored = not args.from_jdupes and store_manifest(args.db_file, args.json_file, args.manifest_format)
 
-    processed_files = load_processed_files(args.db_file)
-    file_to_set_map = {f['filePath']: s for s in match_sets for f in s.get('fileList', [])}
-    
-    logging.info(f"Loaded {len(processed_files)} entries from the state database.")
+    # Both prefixes end in a separator so that /mnt/storage/Media doesn't also match /mnt/storage/Media2.
+    # The mergerfs mount is taken to be the primary path's parent, e.g. /mnt/storage/Media -> /mnt/storage/,
+    # and keeping it as a string lets the hot path slice instead of building Paths.
+    primary_prefix = os.path.join(os.path.abspath(args.primary_path), '')
+    mergerfs_prefix = os.path.join(os.path.dirname(os.path.abspath(args.primary_path)), '')
+    pool_disks = build_pool_disks(args.pool_root)
+    if args.jobs == 0:
+        # The work is I/O-bound per disk, so a few workers per spindle hide syscall latency
+        args.jobs = min(32, 4 * max(1, len(pool_disks)))
+    disk_hints = {}
+    master_paths = {}
+    link_dirs = set()
+    recovery_dir_fds = {}
 
-    db_connection = sqlite3.connect(args.db_file)
+    # All state DB writes are serialized through one writer thread and connection
+    db_connection = db_connect(args.db_file)
+    state_queue = queue.Queue()
+    state_writer = threading.Thread(target=state_db_writer, args=(db_connection, state_queue),
+                                    name="state-db-writer", daemon=True)
+    state_writer.start()
+    # LINKED checks read through a separate connection; WAL lets it run alongside the writer
+    state_reader = sqlite3.connect(args.db_file, check_same_thread=False)
+    find_linked = functools.partial(query_linked_files, state_reader, threading.Lock())
     try:
         # --- Recovery Step ---
         logging.info("--- Checking for incomplete tasks from previous runs... ---")
-        recovery_needed = {k: v for k, v in processed_files.items() if v in ['DELETED', 'PENDING']}
         if not recovery_needed:
             logging.info("No incomplete tasks found.")
         else:
             logging.warning(f"Found {len(recovery_needed)} files needing recovery.")
-            for dup_file in recovery_needed.keys():
+            # Only the sets touching a recovery candidate are kept from this extra manifest pass,
+            # and only as an index into their precomputed master file.
+            set_masters = []
+            file_to_set_map = {}
+            for match_set in open_manifest(args, manifest_stored):
+                files = [f['filePath'] for f in match_set['fileList']]
+                candidates = [f for f in files if f in recovery_needed]
+                if candidates:
+                    for dup_file in candidates:
+                        file_to_set_map[dup_file] = len(set_masters)
+                    set_masters.append(find_master_file(files, primary_prefix))
+            # Grouped by directory so consecutive links reuse the open target directory
+            for dup_file in sorted(recovery_needed, key=os.path.dirname):
                 logging.info(f"Attempting to recover failed link for: {dup_file}")
                 if dup_file not in file_to_set_map:
                     logging.error(f"  - Could not find {dup_file} in the manifest. Cannot recover.")
                     stats['failures'] += 1
                     continue
-                
-                match_set = file_to_set_map[dup_file]
-                master_file = next((f['filePath'] for f in match_set['fileList'] if f.startswith(args.primary_path)), None)
+            
+                master_file = set_masters[file_to_set_map[dup_file]]
 
                 if not master_file:
                     logging.error(f"  - Could not find a master file for {dup_file}. Cannot recover.")
                     stats['failures'] += 1
                     continue
 
-                master_physical_path, physical_disk_root = get_physical_path(master_file, args.pool_root, args.primary_path)
+                master_physical_path, physical_disk_root = get_master_physical_path(master_paths, master_file, pool_disks, mergerfs_prefix, disk_hints)
                 if not master_physical_path:
                     logging.error(f"  - FATAL: Could not determine physical path for master {master_file}. Cannot recover.")
                     stats['failures'] += 1
                     continue
-                
+            
                 try:
                     if args.perform_actions:
-                        link_file(db_connection, master_physical_path, physical_disk_root, dup_file, args.primary_path, stats)
+                        link_file(state_queue, master_physical_path, physical_disk_root, dup_file, mergerfs_prefix, stats, link_dirs,
+                                  recovery_dir_fds)
                         stats['recoveries'] += 1
                     else:
                         logging.info(f"  - [Dry Run] Would recover link for {dup_file}")
                 except Exception as e:
                     logging.error(f"  - FAILED to recover link for {dup_file}. Error: {e}")
                     stats['failures'] += 1
-
-        logging.info("Refreshing file status after recovery check...")
-        processed_files = load_processed_files(args.db_file)
+            close_link_dirs(recovery_dir_fds)
+            # Recovered links must be committed before the main loop's LINKED lookups can see them
+            commit_state_db(state_queue, block=True)
 
         # --- Main Processing Loop ---
-        logging.info(f"--- Starting to process {len(match_sets)} duplicate sets... ---")
-        for match_set in match_sets:
-            files = [f['filePath'] for f in match_set.get('fileList', [])]
-            master_file = next((f for f in files if f.startswith(args.primary_path)), None)
-            
-            if not master_file:
-                continue
-
-            stats['sets_processed'] += 1
-            logging.info(f"Processing set for master: {master_file}")
-            
-            master_physical_path, physical_disk_root = get_physical_path(master_file, args.pool_root, args.primary_path)
-            if not master_physical_path:
-                logging.error(f"    - FATAL: Could not determine physical path for master {master_file}. Skipping set.")
-                stats['failures'] += 1
-                continue
-
-            for dup_file in files:
-                if dup_file == master_file or processed_files.get(dup_file) == 'LINKED':
-                    continue
-
-                logging.info(f"  - Found duplicate: {dup_file}")
-                
-                if args.perform_actions:
-                    try:
-                        update_state_db(db_connection, dup_file, 'PENDING')
-                        
-                        logging.info(f"    - Deleting: {dup_file}")
-                        os.remove(dup_file)
-                        update_state_db(db_connection, dup_file, 'DELETED')
-
-                        link_file(db_connection, master_physical_path, physical_disk_root, dup_file, args.primary_path, stats)
-                    except FileNotFoundError:
-                         logging.warning(f"    - File not found for deletion (already gone?): {dup_file}. Attempting to link.")
-                         try:
-                             link_file(db_connection, master_physical_path, physical_disk_root, dup_file, args.primary_path, stats)
-                         except Exception as e:
-                             logging.error(f"    - FAILED to process {dup_file} after FileNotFoundError. Error: {e}")
-                             stats['failures'] += 1
-                    except Exception as e:
-                        logging.error(f"    - FAILED to process {dup_file}. Error: {e}")
-                        stats['failures'] += 1
-                else:
-                    logging.info(f"    - Would delete: {dup_file}")
-                    logging.info(f"    - Would create hardlink from '{master_physical_path}'")
+        logging.info(f"--- Starting to process duplicate sets with {args.jobs} job(s)... ---")
+        set_args = (args, primary_prefix, mergerfs_prefix, pool_disks, disk_hints, master_paths, link_dirs, find_linked, state_queue)
+        if args.jobs == 1:
+            for match_set in open_manifest(args, manifest_stored):
+                merge_stats(stats, process_match_set(match_set, *set_args))
+        else:
+            # Bound the number of queued sets so the streamed manifest isn't read ahead in full
+            with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                in_flight = set()
+                for match_set in open_manifest(args, manifest_stored):
+                    in_flight.add(executor.submit(process_match_set, match_set, *set_args))
+                    if len(in_flight) >= args.jobs * 2:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            merge_stats(stats, future.result())
+                for future in wait(in_flight).done:
+                    merge_stats(stats, future.result())
     finally:
-        if 'db_connection' in locals() and db_connection:
-            db_connection.close()
-            logging.info("--- Database connection closed. ---")
+        close_link_dirs(recovery_dir_fds)
+        link_dirs.clear()
+        master_paths.clear()
+        state_queue.put(STATE_STOP)
+        state_writer.join()
+        state_reader.close()
+        db_connection.close()
+        logging.info("--- Database connection closed. ---")
 
     logging.info("--- Summary Report ---")
     logging.info(f"  - Total Sets Examined: {stats['sets_processed']}")
@@ -253,29 +789,50 @@ def run_deduplication(args):
 
 if __name__ == "__main__":
     setup_logging()
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
     check_dependencies()
 
     parser = argparse.ArgumentParser(
         description="Finds and consolidates duplicate files across a mergerfs pool by hardlinking.",
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('--json-file', required=True, help="Path to the duplicates.json manifest.")
+    manifest_source = parser.add_mutually_exclusive_group(required=True)
+    manifest_source.add_argument('--json-file', help="Path to the duplicates.json manifest.")
+    manifest_source.add_argument('--from-jdupes', nargs='+', metavar='SCAN_PATH',
+                                 help="Run jdupes over these paths and process its output as it streams in,\n"
+                                      "instead of reading a saved manifest.")
+    parser.add_argument('--manifest-format', choices=['json', 'ndjson'], default='json',
+                        help="Manifest layout: jdupes' JSON output (default), or one match set per line\n"
+                             "as written by manifest_to_ndjson.py.")
     parser.add_argument('--db-file', required=True, help="Path to the SQLite database for tracking state.")
     parser.add_argument('--primary-path', required=True, help="The primary path where 'master' files are kept.")
     parser.add_argument('--pool-root', required=True, help="The root directory of individual disk mounts (e.g., /mnt/pool/).")
     parser.add_argument('--perform-actions', action='store_true', help="Perform delete/link operations. Default is dry-run.")
+    parser.add_argument('--verbose', action='store_true', help="Log every per-file step, not just one line per duplicate set.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of duplicate sets to process in parallel. Default is 1.\n"
+                             "0 picks four per pool disk, up to 32.")
     
     args = parser.parse_args()
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
 
-    if not os.path.exists(args.json_file):
+    if args.json_file and not os.path.exists(args.json_file):
         logging.error(f"Manifest file not found: {args.json_file}")
         sys.exit(1)
+    for scan_path in args.from_jdupes or []:
+        if not os.path.isdir(scan_path):
+            logging.error(f"Scan path not found or not a directory: {scan_path}")
+            sys.exit(1)
     if not os.path.isdir(args.primary_path):
         logging.error(f"Primary path not found or not a directory: {args.primary_path}")
         sys.exit(1)
     if not os.path.isdir(args.pool_root):
         logging.error(f"Pool root not found or not a directory: {args.pool_root}")
         sys.exit(1)
+    if args.jobs < 0:
+        logging.error(f"--jobs must be 0 (automatic) or a positive number, got {args.jobs}")
+        sys.exit(1)
     if not db_initialize(args.db_file):
         sys.exit(1)
     
@@ -0,0 +1,52 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from dedupe import iter_match_sets
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dump_line(match_set):
+    """Serializes one match set as a single NDJSON line."""
+    if orjson:
+        return orjson.dumps(match_set) + b'\n'
+    return json.dumps(match_set, separators=(',', ':')).encode() + b'\n'
+
+def convert_manifest(json_file, ndjson_file):
+    """
+    Rewrites a jdupes JSON manifest as one match set per line; returns the number of sets written.
+    Output goes to a temporary file that only replaces ndjson_file once the whole manifest is read,
+    so an unreadable input never leaves a truncated manifest behind.
+    """
+    count = 0
+    tmp_file = ndjson_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as out:
+            for match_set in iter_match_sets(json_file):
+                out.write(dump_line(match_set))
+                count += 1
+    except BaseException:
+        # iter_match_sets reports parse errors with sys.exit, so SystemExit must clean up too
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, ndjson_file)
+    return count
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(message)s', stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(
+        description="Converts a jdupes JSON manifest to NDJSON for use with dedupe.py --manifest-format ndjson."
+    )
+    parser.add_argument('json_file', help="Path to the duplicates.json manifest written by jdupes.")
+    parser.add_argument('ndjson_file', help="Path to write the NDJSON manifest to.")
+    args = parser.parse_args()
+
+    count = convert_manifest(args.json_file, args.ndjson_file)
+    logging.info(f"Wrote {count} duplicate sets to {args.ndjson_file}")